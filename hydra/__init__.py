@@ -2,6 +2,8 @@
 from __future__ import absolute_import
 
 import logging
+import threading
+from functools import wraps
 
 logger = logging.getLogger(__name__)
 
@@ -9,26 +11,137 @@ from django.conf import settings
 from django.db import models
 from django.db.models.signals import class_prepared
 
-def activate_branch(branch_obj):
+from .utils import forbidden_models
+
+# Sessions whose hydra.branch setting may not match what was last synced
+_UNSYNCED = object()
+
+def _branch_connections(using=None):
+    # Every connection, rather than those the router returns now: routers may
+    # pick a replica per query, and activating a connection costs nothing.
+    from django.db import connections
+    return [connections[using]] if using else connections.all()
+
+def _install_branch_compiler(connection):
+    # Route this connection's queries through compilers that sync the active
+    # branch just before the first statement touching a hydrized table.
+    # Backends with compilers of their own never host hydrized tables.
+    if connection.ops.compiler_module == 'django.db.models.sql.compiler':
+        connection.ops.compiler_module = 'hydra.compiler'
+        connection.ops._cache = None
+        _forget_sync_on_rollback(connection)
+
+def _forget_sync_on_rollback(connection):
+    # A branch synced inside a transaction holds for the session once the
+    # transaction commits, and is undone by rolling back the transaction or a
+    # savepoint it was synced under.
+    commit = connection.commit
+    rollback = connection.rollback
+    savepoint_rollback = connection.savepoint_rollback
+
+    def forget():
+        connection.hydra_synced_branch = _UNSYNCED
+        connection.hydra_sync_savepoints = None
+
+    def on_commit():
+        commit()
+        connection.hydra_sync_savepoints = None
+
+    def on_rollback():
+        rollback()
+        if getattr(connection, 'hydra_sync_savepoints', None) is not None:
+            forget()
+
+    def on_savepoint_rollback(sid):
+        savepoint_rollback(sid)
+        if sid in (getattr(connection, 'hydra_sync_savepoints', None) or ()):
+            forget()
+
+    connection.commit = on_commit
+    connection.rollback = on_rollback
+    connection.savepoint_rollback = on_savepoint_rollback
+
+def activate_branch(branch_obj, using=None):
+    """Makes branch_obj the active branch on the database `using`, or on every
+    database if not given. The session is only updated
+    the first time a connection queries a hydrized table - see sync_branch."""
     if not branch_obj.state == u'open':
         raise ValueError('Only open branches can be activated.')
-    from django.db import transaction, connections
-    cursor = connections['default'].cursor()
-    with transaction.atomic():
-        cursor.execute("DELETE FROM hydra_activebranch WHERE "
-                       "session_id = currval('_hydra_session_id_seq')")
-        cursor.execute("INSERT INTO hydra_activebranch (session_id, branch_name) "
-                       "VALUES (currval('_hydra_session_id_seq'), %s)",
-                       (branch_obj.branch_name,))
-
-def deactivate_branch():
-    from django.db import connections
-    cursor = connections['default'].cursor()
-    cursor.execute("DELETE FROM hydra_activebranch WHERE "
-                   "session_id = currval('_hydra_session_id_seq')")
+    for connection in _branch_connections(using):
+        _install_branch_compiler(connection)
+        connection.hydra_branch = branch_obj.branch_name
+
+def deactivate_branch(using=None):
+    for connection in _branch_connections(using):
+        _install_branch_compiler(connection)
+        connection.hydra_branch = None
+
+def sync_branch(connection):
+    """Points the session's hydra.branch setting, which hydra_branch() reads,
+    at the branch requested for this connection, if they differ. A setting
+    needs no writes, so this works on read-only replicas as well.
+
+    Only queries compiled by the ORM sync the branch: call this before running
+    raw() querysets or cursor statements against hydrized tables."""
+    branch_name = getattr(connection, 'hydra_branch', None)
+    if getattr(connection, 'hydra_synced_branch', _UNSYNCED) == branch_name:
+        return
+    cursor = connection.cursor()
+    cursor.execute("SELECT set_config('hydra.branch', %s, false)",
+                   (branch_name or '',))
+    connection.hydra_synced_branch = branch_name
+    if connection.in_atomic_block or not connection.get_autocommit():
+        # Kept until the transaction, or a savepoint open now, rolls back
+        connection.hydra_sync_savepoints = tuple(connection.savepoint_ids)
+    else:
+        connection.hydra_sync_savepoints = None
+
+class branch(object):
+    """Context manager and decorator that activates branch_obj - or the
+    default branch, if None - on entry and restores whatever branch was
+    active on exit. Like activate_branch, the session is only touched when a
+    hydrized table is queried, and not at all if it is already on the branch."""
+    def __init__(self, branch_obj, using=None):
+        self.branch_obj = branch_obj
+        self.using = using
+        # Connections are per thread, and so is what to restore them to when
+        # a decorated function runs in several threads at once
+        self._local = threading.local()
+
+    @property
+    def _previous(self):
+        if not hasattr(self._local, 'previous'):
+            self._local.previous = []
+        return self._local.previous
+
+    def __enter__(self):
+        connections = _branch_connections(self.using)
+        previous = [(connection, getattr(connection, 'hydra_branch', None))
+                    for connection in connections]
+        if self.branch_obj is None:
+            deactivate_branch(self.using)
+        else:
+            activate_branch(self.branch_obj, self.using)
+        # Only once activated, as __exit__ isn't called if that fails
+        self._previous.append(previous)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for connection, branch_name in self._previous.pop():
+            connection.hydra_branch = branch_name
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return inner
 
 _registered = set()
 def hydrize_model(sender=None, **kwargs):
+    from django.apps import apps
+    if sender._meta.apps is not apps:
+        # Historical models rendered by migrations
+        return
     logger.debug('Model %s is ready.', sender)
     settings.HYDRA_MODELS = set(getattr(settings, 'HYDRA_MODELS', set()) - forbidden_models())
     if (sender not in _registered and sender._meta.app_label != 'hydra' and
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from django.db.models.sql import compiler
+from django.db.models.sql.query import Query
+
+from . import sync_branch
+from .utils import hydrized_tables
+
+
+def _subqueries(node):
+    """Yields the queries nested in a where node, such as the queryset of an
+    __in lookup or the subquery an exclude() across a relation builds."""
+    for child in getattr(node, 'children', ()):
+        for query in _subqueries(child):
+            yield query
+    for attr in ('rhs', 'query_object'):
+        value = getattr(node, attr, None)
+        # A queryset stands for its query
+        value = getattr(value, 'query', value)
+        if isinstance(value, Query):
+            yield value
+
+
+def touches_hydra(query):
+    """Whether a query, or any query nested in its filters, reads from or
+    writes to a hydrized table"""
+    tables = hydrized_tables()
+    if query.model is not None and query.model._meta.db_table in tables:
+        return True
+    if any(join.table_name in tables for join in query.alias_map.values()):
+        return True
+    return any(touches_hydra(subquery) for subquery in _subqueries(query.where))
+
+
+class BranchAwareCompilerMixin(object):
+    def execute_sql(self, *args, **kwargs):
+        if touches_hydra(self.query):
+            sync_branch(self.connection)
+        return super(BranchAwareCompilerMixin, self).execute_sql(*args, **kwargs)
+
+
+for _name in ('SQLCompiler', 'SQLInsertCompiler', 'SQLDeleteCompiler',
+              'SQLUpdateCompiler', 'SQLAggregateCompiler', 'SQLDateCompiler',
+              'SQLDateTimeCompiler'):
+    if hasattr(compiler, _name):
+        globals()[_name] = type(_name,
+                                (BranchAwareCompilerMixin, getattr(compiler, _name)),
+                                {})
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+import json
+
+from django.db import connections
+
+from . import branch, sync_branch
+
+
+def _walk(node, parent=None):
+    """Yields (node, exclusive time in ms, parent node) for every node of an
+    EXPLAIN (FORMAT JSON) plan."""
+    children = node.get('Plans', [])
+    inclusive = lambda n: n.get('Actual Total Time', 0) * n.get('Actual Loops', 1)
+    exclusive = inclusive(node) - sum(inclusive(child) for child in children)
+    yield node, max(exclusive, 0), parent
+    for child in children:
+        for item in _walk(child, node):
+            yield item
+
+
+def _filters_on_branch(node):
+    # hydra_branch() is inlined into the filters of raw table scans, so its
+    # cost shows up there rather than as a node of its own
+    return any("current_setting('hydra.branch'" in node.get(key, '')
+               for key in ('Filter', 'Index Cond', 'Recheck Cond'))
+
+
+def analyze_plan(plan):
+    """Breaks the time of an EXPLAIN (ANALYZE, FORMAT JSON) plan down into the
+    parts Hydra adds to a query, and flags sequential scans on raw tables.
+    Time is charged by the relation a node reads, wherever the node sits in
+    the plan - a raw table scanned in a SubPlan is still raw scan time.
+    Checking rows against the active branch happens within those scans, whose
+    relations are listed under branch_filters."""
+    report = {'total_time': plan.get('Execution Time',
+                                     plan.get('Total Runtime', 0)),
+              'raw_scan_time': 0,
+              'window_time': 0,
+              'seq_scans': [],
+              'branch_filters': [],
+              'plan': plan}
+    for node, time, parent in _walk(plan['Plan']):
+        node_type = node['Node Type']
+        relation = node.get('Relation Name', '')
+        if relation.startswith('_raw_'):
+            report['raw_scan_time'] += time
+            if node_type == 'Seq Scan':
+                report['seq_scans'].append(relation)
+            if _filters_on_branch(node) and relation not in report['branch_filters']:
+                report['branch_filters'].append(relation)
+        elif node_type == 'WindowAgg' or (
+                node_type == 'Sort' and parent and parent['Node Type'] == 'WindowAgg'):
+            report['window_time'] += time
+    return report
+
+
+def explain_queryset(queryset, branch_obj=None):
+    """Runs EXPLAIN (ANALYZE, BUFFERS) for queryset in the default branch and,
+    if given, with branch_obj active. Returns a report per run, as from
+    analyze_plan, with the name of its branch added."""
+    connection = connections[queryset.db]
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    reports = []
+    for branch_to_explain in [None] + ([branch_obj] if branch_obj else []):
+        with branch(branch_to_explain, using=queryset.db):
+            # A raw cursor bypasses the compiler that would sync the branch
+            sync_branch(connection)
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+            plan, = cursor.fetchone()
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        report = analyze_plan(plan[0])
+        report['branch'] = branch_to_explain.branch_name if branch_to_explain else None
+        if report['seq_scans']:
+            logger.warning('Sequential scan on %s in branch %s',
+                           ', '.join(report['seq_scans']), report['branch'])
+        reports.append(report)
+    return reports
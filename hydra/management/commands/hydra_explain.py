@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from hydra.explain import explain_queryset
+from hydra.models import Branch
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = ("Profiles a query against a hydrized model in the default branch "
+            "and, optionally, in another branch.")
+    option_list = BaseCommand.option_list + (
+        make_option('--branch', dest='branch',
+                    help='Name of the branch to profile besides default.'),
+        make_option('--filter', dest='filters', action='append', default=[],
+                    help='A field lookup to filter by, as lookup=value. '
+                         'May be given more than once.'),
+        make_option('--plan', dest='plan', action='store_true', default=False,
+                    help='Print the full plan as JSON.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give exactly one app_label.ModelName.')
+        try:
+            model_cls = models.get_model(*args[0].split('.', 1))
+        except (LookupError, TypeError):
+            model_cls = None
+        if model_cls is None:
+            raise CommandError('Unknown model %s' % args[0])
+        try:
+            filters = dict(lookup.split('=', 1) for lookup in options['filters'])
+        except ValueError:
+            raise CommandError('Filters must be given as lookup=value.')
+        branch_obj = None
+        if options['branch']:
+            try:
+                branch_obj = Branch.objects.get(branch_name=options['branch'])
+            except Branch.DoesNotExist:
+                raise CommandError('Unknown branch %s' % options['branch'])
+            if branch_obj.state != u'open':
+                raise CommandError('Branch %s is %s; only open branches can be '
+                                   'profiled.' % (branch_obj, branch_obj.state))
+
+        queryset = model_cls._default_manager.filter(**filters)
+        for report in explain_queryset(queryset, branch_obj):
+            self.stdout.write('Branch: %s' % (report['branch'] or '(default)'))
+            self.stdout.write('  Total:           %8.3f ms' % report['total_time'])
+            self.stdout.write('  Raw table scans: %8.3f ms' % report['raw_scan_time'])
+            self.stdout.write('  Window sorts:    %8.3f ms' % report['window_time'])
+            if report['branch_filters']:
+                self.stdout.write('  Branch filtered in the scans of %s'
+                                  % ', '.join(report['branch_filters']))
+            for table in report['seq_scans']:
+                self.stdout.write('  WARNING: sequential scan on %s' % table)
+            if options['plan']:
+                self.stdout.write(json.dumps(report['plan'], indent=2))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404
+
+from . import branch
+
+
+class BranchMiddleware(object):
+    """Activates the branch named by the request for the duration of the
+    request. The branch name is taken from the session key named by
+    settings.HYDRA_BRANCH_SESSION_KEY and then, only if
+    settings.HYDRA_BRANCH_HEADER names one (e.g. 'HTTP_X_HYDRA_BRANCH'), from
+    that header. Requests that don't name a branch are left alone and cost
+    nothing. A session naming a branch that is no longer open is returned to
+    the default branch, while a header naming one gets a 404.
+
+    Anyone able to send the header can pick a branch, so projects enabling it
+    should override has_branch_permission."""
+
+    def get_session_key(self):
+        return getattr(settings, 'HYDRA_BRANCH_SESSION_KEY', 'hydra_branch')
+
+    def get_branch_name(self, request):
+        session = getattr(request, 'session', None)
+        if session is not None and session.get(self.get_session_key()):
+            return session[self.get_session_key()]
+        header = getattr(settings, 'HYDRA_BRANCH_HEADER', None)
+        if header:
+            return request.META.get(header)
+
+    def has_branch_permission(self, request, branch_obj):
+        """Whether the request may work in branch_obj. Denied requests get a
+        403."""
+        return True
+
+    def process_request(self, request):
+        branch_name = self.get_branch_name(request)
+        if not branch_name:
+            return
+        from .models import Branch
+        try:
+            branch_obj = Branch.objects.get(branch_name=branch_name, state=u'open')
+        except Branch.DoesNotExist:
+            session = getattr(request, 'session', None)
+            if session is not None and session.get(self.get_session_key()) == branch_name:
+                # The branch was merged or closed since it was picked, which
+                # shouldn't keep its users out of the site
+                del session[self.get_session_key()]
+                return
+            raise Http404('No open branch named %s' % branch_name)
+        if not self.has_branch_permission(request, branch_obj):
+            raise PermissionDenied
+        request.hydra_branch = branch(branch_obj)
+        request.hydra_branch.__enter__()
+
+    def _exit_branch(self, request):
+        ctx = getattr(request, 'hydra_branch', None)
+        if ctx is not None:
+            del request.hydra_branch
+            ctx.__exit__(None, None, None)
+
+    def process_response(self, request, response):
+        self._exit_branch(request)
+        return response
+
+    def process_exception(self, request, exception):
+        self._exit_branch(request)
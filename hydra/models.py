@@ -5,23 +5,31 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+import copy
 import sys
 
 import django
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models, router, connections, transaction, utils
+from django.db import models, router, connections, transaction
+from django.utils import timezone
 from django.db.backends.postgresql_psycopg2.creation import DatabaseCreation
 if django.get_version() < (1,7):
     from django.db.models.signals import post_syncdb as post_migrate
 else:
     from django.db.models.signals import post_migrate
 from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
 
-from .utils import with_m2ms, forbidden_models, is_hydrized
+from .utils import (with_m2ms, forbidden_models, is_hydrized, hydrized_models,
+                    hydra_table_databases, m2m_key)
+
+# Namespace for Hydra's advisory locks, keyed on hashtext(branch_name)
+HYDRA_LOCK_NAMESPACE = 0x4879
 
 class Branch(models.Model):
     branch_name = models.CharField(max_length=50, unique=True)
-    created_by = models.ForeignKey('auth.User')
+    # Branches are mirrored to databases that needn't hold the creating user
+    created_by = models.ForeignKey('auth.User', db_constraint=False)
     created = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
     state = models.CharField(
@@ -33,47 +41,81 @@ class Branch(models.Model):
     def __unicode__(self):
         return self.branch_name
 
-class ActiveBranch(models.Model):
-    session_id = models.BigIntegerField(primary_key=True)
-    branch_name = models.CharField(max_length=50)
+def mirror_branch(sender=None, instance=None, using=None, raw=False, **kwargs):
+    """Raw tables reference hydra_branch, and their triggers look up branch
+    states, on every database holding them - so each of those keeps a copy
+    of every branch saved wherever the router sends Branch."""
+    if raw or using != router.db_for_write(Branch):
+        # Only branches saved where the router sends them are mirrored
+        return
+    # A copy keyed by name, so the mirror keeps its own row id and a branch
+    # left behind by a rolled back create is simply taken over
+    for alias in hydra_table_databases() - set([using]):
+        Branch.objects.using(alias).update_or_create(
+            branch_name=instance.branch_name,
+            defaults={'created_by_id': instance.created_by_id,
+                      'created': instance.created,
+                      'last_modified': instance.last_modified,
+                      'state': instance.state})
+post_save.connect(mirror_branch, sender=Branch)
+
+def unmirror_branch(sender=None, instance=None, using=None, **kwargs):
+    if using != router.db_for_write(Branch):
+        return
+    for alias in hydra_table_databases() - set([using]):
+        Branch.objects.using(alias).filter(branch_name=instance.branch_name).delete()
+post_delete.connect(unmirror_branch, sender=Branch)
 
 def after_hydra_migrate(sender=None, **kwargs):
     if django.get_version() >= (1,7):
         # After 1.7, this is an AppConfig, not a models module
         sender = sender.models_module
-    if sender == models.get_app('hydra'):
-        with transaction.atomic():
-            db_cur = connections[(kwargs.get('using')
-                                  if django.get_version() >= (1,7)
-                                  else kwargs.get('db'))].cursor()
-            db_cur.execute("SELECT count(*) FROM pg_class WHERE pg_class.relkind='S' "
-                           "and pg_class.relname='_hydra_session_id_seq'")
-            count, = db_cur.fetchone()
-            if not count:
-                db_cur.execute('CREATE SEQUENCE _hydra_session_id_seq NO CYCLE')
-            # We need a view for outer joins during selects, but the function
-            # can be used otherwise - with the STABLE modifier, we get some efficiency
-            db_cur.execute("CREATE OR REPLACE VIEW _active_branch (branch_name) AS "
-                           "SELECT branch_name FROM ("
-                           " SELECT null::VARCHAR(50) AS branch_name UNION "
-                           " SELECT branch_name FROM hydra_activebranch WHERE "
-                           " session_id = currval('_hydra_session_id_seq')) sub "
-                           "ORDER BY branch_name LIMIT 1")
+    using = (kwargs.get('using') if django.get_version() >= (1,7)
+             else kwargs.get('db'))
+    if sender == models.get_app('hydra') and using in hydra_table_databases():
+        with transaction.atomic(using=using):
+            db_cur = connections[using].cursor()
+            # The active branch is a setting of the session, so switching it
+            # writes nothing - which read-only replicas depend on. With the
+            # STABLE modifier, it is read once per statement.
             db_cur.execute("CREATE OR REPLACE FUNCTION hydra_branch() RETURNS VARCHAR(50) "
-                           "AS $$ SELECT branch_name FROM _active_branch $$ LANGUAGE SQL STABLE ")
+                           "AS $$ SELECT NULLIF(current_setting('hydra.branch', true), '')"
+                           "::VARCHAR(50) $$ LANGUAGE SQL STABLE ")
+            # Left over from when the active branch was kept in a table
+            db_cur.execute("DROP VIEW IF EXISTS _active_branch")
+            # Writes to a branch hold its advisory lock shared until they
+            # commit, so a merge taking it exclusively to close the branch
+            # waits them out - and writes after that find the branch closed.
+            # Copies that a delete in default spawns into branches are
+            # dropped for a closed branch rather than failing the delete.
+            db_cur.execute("CREATE OR REPLACE FUNCTION _hail_hydra_branch_open () "
+                           "RETURNS trigger AS "
+                           "$$ "
+                           "BEGIN "
+                           "PERFORM pg_advisory_xact_lock_shared(%(namespace)s, hashtext(NEW._branch_name)); "
+                           "PERFORM 1 FROM hydra_branch WHERE "
+                           "branch_name = NEW._branch_name AND state = 'open'; "
+                           "IF NOT FOUND THEN "
+                           "    IF pg_trigger_depth() > 1 THEN "
+                           "        RETURN NULL; "
+                           "    END IF; "
+                           "    RAISE 'Branch %% is not open', NEW._branch_name "
+                           "    USING ERRCODE = 'object_not_in_prerequisite_state'; "
+                           "END IF; "
+                           "RETURN NEW; "
+                           "END; "
+                           "$$ "
+                           "LANGUAGE plpgsql"
+                           "" % {'namespace': HYDRA_LOCK_NAMESPACE})
 post_migrate.connect(after_hydra_migrate)
 
 
-def get_session_identifier_from_sequence(sender=None, connection=None, **kwargs):
-    """A sequence will be used to yield a unique identifier per session to set
-    the active branch for this session."""
-    db_cur = connection.cursor()
-    try:
-        db_cur.execute("SELECT nextval('_hydra_session_id_seq')")
-    except utils.ProgrammingError:
-        # The sequence hasn't been created yet... this is probably a syncdb/migrate
-        pass
-connection_created.connect(get_session_identifier_from_sequence)
+def reset_session_branch(sender=None, connection=None, **kwargs):
+    """A new session starts out in the default branch, whatever the last
+    session of this connection had synced."""
+    connection.hydra_synced_branch = None
+    connection.hydra_sync_savepoints = None
+connection_created.connect(reset_session_branch)
 
 def generate_raw_model_for(model_cls):
     # FIXME: Throw an error if there's a non-hydrized model with an FK to this one
@@ -91,50 +133,178 @@ def generate_raw_model_for(model_cls):
              '_deleted': models.BooleanField(default=False),
              '_branch_name': models.CharField(max_length=50, null=True, db_index=True),
              '_updated': models.DateTimeField()}
-    attrs.update(dict(**{f.attname: f for f in model_cls._meta.fields}))
+    fields = {f.name: copy.deepcopy(f) for f in model_cls._meta.fields}
+    for f in fields.values():
+        if f.rel:
+            # Raw models don't get reverse relations on the models they point to
+            f.rel.related_name = '+'
+    attrs.update(fields)
     return type(name, bases, attrs)
 
 def generate_hydra_models(for_model):
     for model_cls in with_m2ms(for_model) - forbidden_models(as_cls=True):
-        setattr(models.get_app('hydra'),
+        setattr(sys.modules[__name__],
                 'Hydra%s' % model_cls.__name__,
                 generate_raw_model_for(model_cls))
 
-def initialize_model_for_hydra(ModelCls):
-    db_conn = connections[router.db_for_write(ModelCls)]
+def _raw_column(field):
+    # Raw tables keep each row's identity across branches in _id
+    return '_id' if field.primary_key else field.column
+
+def _drop_constraints(db_cur, table, contype, column):
+    """Drops the constraints of type contype ('f' for foreign keys, 'u' for
+    unique) on table that involve column."""
+    db_cur.execute("SELECT DISTINCT conname FROM pg_constraint "
+                   "JOIN pg_attribute ON attrelid = conrelid AND attnum = ANY(conkey) "
+                   "WHERE conrelid = %s::regclass AND contype = %s AND attname = %s",
+                   (table, contype, column))
+    for conname, in db_cur.fetchall():
+        db_cur.execute('ALTER TABLE %s DROP CONSTRAINT "%s"' % (table, conname))
+
+def _replace_trigger(db_cur, ModelCls, name, definition, **params):
+    """Creates trigger `name` on ModelCls's raw table, replacing any earlier
+    one. definition follows the trigger's name in CREATE TRIGGER; both are
+    formatted with the model's table and params."""
+    params['table'] = ModelCls._meta.db_table
+    db_cur.execute('DROP TRIGGER IF EXISTS %s ON _raw_%s' % (name % params, params['table']))
+    db_cur.execute('CREATE TRIGGER %s %s' % (name % params, definition % params))
+
+def _create_m2m_rules(db_cur, ModelCls, overlay_key, fields_except_pk):
+    """Creates the view and rules of an M2M through table. Rather than
+    windowing over every row like other hydrized views, branch rows overlay
+    default rows joining the same pair, found with an index lookup on both
+    foreign keys, so filters on either key reach the raw table's indexes."""
+    params = {'table': ModelCls._meta.db_table,
+              'fields': ', '.join(fields_except_pk),
+              'vals': ', '.join(['NEW.%s' % col for col in fields_except_pk]),
+              'old_vals': ', '.join(['OLD.%s' % col for col in fields_except_pk]),
+              'key': ', '.join(overlay_key),
+              'new_key_match': ' AND '.join(['%(col)s = NEW.%(col)s' % {'col': col}
+                                             for col in overlay_key]),
+              'overlay_match': ' AND '.join(['overlay.%(col)s = raw.%(col)s' % {'col': col}
+                                             for col in overlay_key]),
+              'value_map': ', '.join(['%(col)s = NEW.%(col)s' % {'col': col}
+                                      for col in fields_except_pk])}
+
+    db_cur.execute(
+        "CREATE OR REPLACE VIEW %(table)s AS "
+        "SELECT raw._id AS id, %(fields)s FROM _raw_%(table)s raw "
+        "WHERE raw._deleted = 'f' AND ("
+        "raw._branch_name = hydra_branch() OR ("
+        "raw._branch_name IS NULL AND NOT EXISTS ("
+        "SELECT 1 FROM _raw_%(table)s overlay WHERE "
+        "%(overlay_match)s AND overlay._branch_name = hydra_branch())))"
+        "" % params
+    )
+
+    # Adding a pair removed earlier in the same branch revives its row
+    db_cur.execute(
+        "CREATE OR REPLACE RULE _hail_hydra_insert AS ON INSERT TO %(table)s DO INSTEAD ("
+        "UPDATE _raw_%(table)s "
+        "SET _deleted = 'f', _updated = statement_timestamp() "
+        "WHERE %(new_key_match)s AND _deleted AND "
+        "_branch_name IS NOT DISTINCT FROM hydra_branch(); "
+        "INSERT INTO _raw_%(table)s "
+        "(_id, _branch_name, %(fields)s) "
+        "SELECT nextval('_raw_%(table)s__id_seq'), hydra_branch(), %(vals)s "
+        "WHERE NOT EXISTS ("
+        "SELECT 1 FROM _raw_%(table)s WHERE %(new_key_match)s AND "
+        "_branch_name IS NOT DISTINCT FROM hydra_branch()) "
+        "ON CONFLICT DO NOTHING)"
+        "" % params
+    )
+
+    db_cur.execute(
+        "CREATE OR REPLACE RULE _hail_hydra_update AS ON UPDATE TO %(table)s DO INSTEAD "
+        "UPDATE _raw_%(table)s "
+        "SET %(value_map)s, _updated = statement_timestamp() "
+        "WHERE _id = OLD.id AND "
+        "_branch_name IS NOT DISTINCT FROM hydra_branch()"
+        "" % params
+    )
+
+    # Removing a pair in a branch leaves a deleted row in the branch that
+    # hides the default one
+    db_cur.execute(
+        "CREATE OR REPLACE RULE _hail_hydra_delete AS ON DELETE TO %(table)s DO INSTEAD ("
+        "INSERT INTO _raw_%(table)s "
+        "(_id, _branch_name, _deleted, %(fields)s) "
+        "SELECT OLD.id, hydra_branch(), 't', %(old_vals)s "
+        "WHERE hydra_branch() IS NOT NULL "
+        "ON CONFLICT (%(key)s, _branch_name) DO UPDATE "
+        "SET _deleted = 't', _updated = statement_timestamp(); "
+        "UPDATE _raw_%(table)s "
+        "SET _deleted = 't', _updated = statement_timestamp() "
+        "WHERE _id = OLD.id AND _branch_name IS NULL AND hydra_branch() IS NULL)"
+        "" % params
+    )
+
+def initialize_hydra(using=None):
+    """Initializes every hydrized model on each database the router allows it
+    to be migrated to, or only on `using` if given."""
+    for model_cls in hydrized_models():
+        for alias in ([using] if using else connections):
+            if router.allow_migrate(alias, model_cls):
+                initialize_model_for_hydra(model_cls, using=alias)
+
+def initialize_model_for_hydra(ModelCls, using=None):
+    """Moves ModelCls's table aside as its raw table and puts a view with
+    rules and triggers in its place. If the raw table already exists, the
+    view, rules, triggers and indexes are created anew, bringing databases
+    initialized by earlier versions of Hydra up to date."""
+    using = using or router.db_for_write(ModelCls)
+    db_conn = connections[using]
     db_cur = db_conn.cursor()
 
-    with transaction.atomic():
+    with transaction.atomic(using=using):
         db_cur.execute("SELECT COUNT(*) FROM pg_tables WHERE schemaname='public' AND "
                        "tablename = %s", ('_raw_%s' % ModelCls._meta.db_table,))
         result, = db_cur.fetchone()
 
         if result:
-            logger.info('Model %s already initialized for Hydra', ModelCls)
-            return
+            logger.info('Model %s already initialized for Hydra, upgrading', ModelCls)
+        else:
+            # Rename existing table
+            db_cur.execute('ALTER TABLE %(table)s RENAME TO _raw_%(table)s' %
+                           {'table': ModelCls._meta.db_table})
+            # FIXME: Find all indexes - single and multi-col, unique and not - and rewrite them to use branch_name
+
+            db_cur.execute('CREATE SEQUENCE _raw_%(table)s__id_seq' %
+                           {'table': ModelCls._meta.db_table})
 
-        # Rename existing table
-        db_cur.execute('ALTER TABLE %(table)s RENAME TO _raw_%(table)s' %
-                       {'table': ModelCls._meta.db_table})
-        # FIXME: Find all indexes - single and multi-col, unique and not - and rewrite them to use branch_name
-
-        # Create new table
-        db_cur.execute("CREATE TABLE %(table)s ( LIKE _raw_%(table)s )" %
-                       {'table': ModelCls._meta.db_table})
-
-        db_cur.execute('CREATE SEQUENCE _raw_%(table)s__id_seq' %
-                       {'table': ModelCls._meta.db_table})
-
-        # Hydra fields need to be added
-        # Unique index on branch + effective ID needs to be added
-        db_cur.execute("ALTER TABLE _raw_%(table)s "
-                       "ADD COLUMN _id INTEGER NOT NULL, "
-                       "ADD COLUMN _deleted BOOLEAN DEFAULT 'f', "
-                       "ADD COLUMN _branch_name VARCHAR(50) REFERENCES hydra_branch(branch_name), "
-                       "ADD COLUMN _updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, "
-                       "ADD CONSTRAINT %(table)s_branch_eff_id_uniq_tgthr UNIQUE (_id, _branch_name)"
+            # Hydra fields need to be added
+            # Unique index on branch + effective ID needs to be added
+            db_cur.execute("ALTER TABLE _raw_%(table)s "
+                           "ADD COLUMN _id INTEGER NOT NULL, "
+                           "ADD COLUMN _deleted BOOLEAN DEFAULT 'f', "
+                           "ADD COLUMN _branch_name VARCHAR(50) REFERENCES hydra_branch(branch_name), "
+                           "ADD COLUMN _updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, "
+                           "ADD CONSTRAINT %(table)s_branch_eff_id_uniq_tgthr UNIQUE (_id, _branch_name)"
+                           "" % {'table': ModelCls._meta.db_table})
+
+        # Everything from here on replaces what an earlier run created.
+        # NULLs never collide in the constraint above, so default rows need
+        # their own unique index for upserts to target
+        db_cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS %(table)s_default_eff_id_uniq "
+                       "ON _raw_%(table)s (_id) WHERE _branch_name IS NULL"
                        "" % {'table': ModelCls._meta.db_table})
 
+        overlay_key = m2m_key(ModelCls)
+        if overlay_key:
+            # Through rows are identified across branches by the pair of rows
+            # they join rather than by _id, so Django's unique pair becomes
+            # unique per branch. The same indexes serve the overlay lookups.
+            _drop_constraints(db_cur, '_raw_%s' % ModelCls._meta.db_table,
+                              'u', overlay_key[0])
+            db_cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS %(table)s_branch_m2m_uniq "
+                           "ON _raw_%(table)s (%(key)s, _branch_name)"
+                           "" % {'table': ModelCls._meta.db_table,
+                                 'key': ', '.join(overlay_key)})
+            db_cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS %(table)s_default_m2m_uniq "
+                           "ON _raw_%(table)s (%(key)s) WHERE _branch_name IS NULL"
+                           "" % {'table': ModelCls._meta.db_table,
+                                 'key': ', '.join(overlay_key)})
+
         fields_except_pk = [field.column for field in ModelCls._meta.fields if not field.primary_key]
 
         # We have to implement referential integrity using triggers.
@@ -175,9 +345,8 @@ def initialize_model_for_hydra(ModelCls):
             "(_id, _branch_name, %(fields)s) "
             "SELECT OLD._id, hydra_branch.branch_name AS _branch_name, %(old_fields)s "
             "FROM hydra_branch "
-            "WHERE hydra_branch.state = 'open' AND NOT EXISTS ("
-            "          SELECT 1 FROM _raw_%(table)s WHERE "
-            "          _id = OLD.id AND _branch_name = hydra_branch.branch_name); "
+            "WHERE hydra_branch.state = 'open' "
+            "ON CONFLICT DO NOTHING; "
             "END IF; "
             "RETURN NEW; "
             "END; "
@@ -188,53 +357,67 @@ def initialize_model_for_hydra(ModelCls):
                   'old_fields': ', '.join(['OLD.%s' % f for f in fields_except_pk])}
         )
 
-        db_cur.execute(
-            "CREATE TRIGGER _hail_hydra_def_del_%(table)s BEFORE UPDATE "
-            "ON _raw_%(table)s FOR EACH ROW WHERE _branch_name IS NULL "
-            "DO _hail_hydra_def_del_%(table)s()"
-            "" % {'table': ModelCls._meta.db_table}
+        _replace_trigger(
+            db_cur, ModelCls, '_hail_hydra_def_del_%(table)s',
+            "BEFORE UPDATE "
+            "ON _raw_%(table)s FOR EACH ROW WHEN (OLD._branch_name IS NULL) "
+            "EXECUTE PROCEDURE _hail_hydra_def_del_%(table)s()"
+        )
+
+        # Writes in a branch wait out a merge closing it, and fail once it
+        # is closed
+        _replace_trigger(
+            db_cur, ModelCls, '_hail_hydra_open_%(table)s',
+            "BEFORE INSERT OR UPDATE "
+            "ON _raw_%(table)s FOR EACH ROW WHEN (NEW._branch_name IS NOT NULL) "
+            "EXECUTE PROCEDURE _hail_hydra_branch_open()"
         )
 
-        creator = DatabaseCreation(connections['default'])
+        creator = DatabaseCreation(db_conn)
         for f in ModelCls._meta.fields:
             if not isinstance(f, models.ForeignKey):
                 continue
             related_model = f.rel.to
             if is_hydrized(related_model):
                 # Foreign key constraints between hydrized tables need to be removed
-                db_cur.execute("ALTER TABLE _raw_%(table)s "
-                               "DROP CONSTRAINT %(table)s_%(column)s_fkey"
-                               "" % {'table': ModelCls._meta.db_table,
-                                     'column': f.column})
+                _drop_constraints(db_cur, '_raw_%s' % ModelCls._meta.db_table,
+                                  'f', f.column)
                 # Forward consistency triggers between hydrized tables
-                # These triggers operate on the active branch, so no raw tables
-                db_cur.execute("CREATE FUNCTION _hail_hydra_fwd_%(table)s_%(column)s () "
+                # The referenced row must be live in the row's branch, or in
+                # default if the branch hasn't touched it
+                db_cur.execute("CREATE OR REPLACE FUNCTION _hail_hydra_fwd_%(table)s_%(column)s () "
                                "RETURNS trigger AS "
                                "$$ "
                                "BEGIN "
-                               "SELECT 1 FROM %(rel_table)s WHERE "
-                               "%(rel_column)s = NEW.%(column)s; "
-                               "IF NOT FOUND THEN "
-                               "    RAISE 'Foreign key constraint violation %(table)s.%(column)s -> %(rel_table).%(rel_column)s', "
-                               "    USING ERRCODE = 'foreign_key_violation'; "
-                               "ENDIF; "
-                               "RETURN NEW;"
+                               "IF NEW.%(column)s IS NOT NULL AND NOT NEW._deleted THEN "
+                               "    PERFORM 1 FROM ("
+                               "        SELECT _deleted FROM _raw_%(rel_table)s WHERE "
+                               "        %(rel_column)s = NEW.%(column)s AND "
+                               "        (_branch_name IS NULL OR _branch_name = NEW._branch_name) "
+                               "        ORDER BY _branch_name LIMIT 1) ref "
+                               "    WHERE NOT ref._deleted; "
+                               "    IF NOT FOUND THEN "
+                               "        RAISE 'Foreign key constraint violation %(table)s.%(column)s -> %(rel_table)s.%(rel_column)s' "
+                               "        USING ERRCODE = 'foreign_key_violation'; "
+                               "    END IF; "
+                               "END IF; "
+                               "RETURN NEW; "
                                "END; "
                                "$$ "
                                "LANGUAGE plpgsql"
                                "" % {'table': ModelCls._meta.db_table,
                                      'column': f.column,
-                                     'rel_table': f.rel.to._meta.db_table,
-                                     'rel_column': f.rel.field_name}
+                                     'rel_table': related_model._meta.db_table,
+                                     'rel_column': _raw_column(f.rel.get_related_field())}
                                )
-                db_cur.execute("CREATE TRIGGER _hail_hydra_fwd_%(table)s_%(column)s "
-                               "BEFORE INSERT OR UPDATE ON %(table)s FOR EACH ROW "
-                               "DO _hail_hydra_fwd_%(table)s_%(column)s()"
-                               "" % {'table': ModelCls._meta.db_table,
-                                     'column': f.column})
+                _replace_trigger(db_cur, ModelCls,
+                                 '_hail_hydra_fwd_%(table)s_%(column)s',
+                                 "BEFORE INSERT OR UPDATE ON _raw_%(table)s FOR EACH ROW "
+                                 "EXECUTE PROCEDURE _hail_hydra_fwd_%(table)s_%(column)s()",
+                                 column=f.column)
 
         for rel_obj in ModelCls._meta.get_all_related_objects():
-            rel_model = rel_obj.model._meta.db_table
+            rel_model = rel_obj.model
             rel_field = rel_obj.field
             if not is_hydrized(rel_model):
                 # Non-hydrized models may not have FK's to hydrized models
@@ -246,39 +429,47 @@ def initialize_model_for_hydra(ModelCls):
                                                  'table': ModelCls._meta.db_table,
                                                  'rel_column': rel_field.column,
                                                  'column': rel_field.rel.field_name})
+            if rel_field.rel.get_related_field().primary_key:
+                # _id never changes once a row is written
+                continue
             # Backward consistency UPDATE trigger: if a row in "table" changes and
             # it involves a change to the column that "rel_field" points to,
             # ensure that there are no rows in rel_table with that value
-            db_cur.execute("CREATE FUNCTION _hail_hydra_ubkwd_%(rel_table)s_%(rel_column)s () "
-                           "RETURN trigger AS "
+            db_cur.execute("CREATE OR REPLACE FUNCTION _hail_hydra_ubkwd_%(rel_table)s_%(rel_column)s () "
+                           "RETURNS trigger AS "
                            "$$ "
                            "BEGIN "
-                           "SELECT 1 FROM %(rel_table)s WHERE "
-                           "%(rel_table)s.%(rel_column)s = OLD.%(column)s; "
+                           "PERFORM 1 FROM _raw_%(rel_table)s WHERE "
+                           "%(rel_column)s = OLD.%(column)s AND NOT _deleted AND "
+                           "(_branch_name IS NULL OR _branch_name = OLD._branch_name); "
                            "IF FOUND THEN "
-                           "    RAISE 'Integrity violation %(rel_table)s.%(rel_column)s -> %(table)s.%(column)s', "
-                           "    USING ERRCODE = 'integrity_constraint_violation';"
-                           "ENDIF; "
+                           "    RAISE 'Integrity violation %(rel_table)s.%(rel_column)s -> %(table)s.%(column)s' "
+                           "    USING ERRCODE = 'integrity_constraint_violation'; "
+                           "END IF; "
+                           "RETURN NEW; "
                            "END; "
                            "$$ "
                            "LANGUAGE plpgsql"
                            "" % {'rel_table': rel_model._meta.db_table,
                                  'table': ModelCls._meta.db_table,
                                  'rel_column': rel_field.column,
-                                 'column': rel_field.rel.field_name})
-            db_cur.execute("CREATE TRIGGER _hail_hydra_ubkwd_%(rel_table)s_%(rel_column)s "
-                           "BEFORE UPDATE ON %(table)s FOR EACH ROW "
-                           "WHERE OLD.%(column)s IS DISTINCT FROM NEW.%(columns)s "
-                           "DO _hail_hydra_ubkwd_%(rel_table)s_%(rel_column)s()"
-                           "" % {'rel_table': rel_model._meta.db_table,
-                                 'table': ModelCls._meta.db_table,
-                                 'rel_column': rel_field.column,
-                                 'column': rel_field.rel.field_name})
+                                 'column': rel_field.rel.get_related_field().column})
+            _replace_trigger(db_cur, ModelCls,
+                             '_hail_hydra_ubkwd_%(rel_table)s_%(rel_column)s',
+                             "BEFORE UPDATE ON _raw_%(table)s FOR EACH ROW "
+                             "WHEN (OLD.%(column)s IS DISTINCT FROM NEW.%(column)s) "
+                             "EXECUTE PROCEDURE _hail_hydra_ubkwd_%(rel_table)s_%(rel_column)s()",
+                             rel_table=rel_model._meta.db_table,
+                             rel_column=rel_field.column,
+                             column=rel_field.rel.get_related_field().column)
 
+        if overlay_key:
+            _create_m2m_rules(db_cur, ModelCls, overlay_key, fields_except_pk)
+            return
 
-        # Create view over new table
+        # Create view in place of the table
         db_cur.execute(
-            'CREATE RULE "_RETURN" AS ON SELECT TO %(table)s DO INSTEAD '
+            "CREATE OR REPLACE VIEW %(table)s AS "
             "SELECT id, %(fields)s FROM ("
             "SELECT _id AS id, %(fields)s, _deleted, "
             "row_number() OVER (PARTITION BY _id ORDER BY _branch_name) AS _row "
@@ -291,7 +482,7 @@ def initialize_model_for_hydra(ModelCls):
 
         # INSERT rule
         db_cur.execute(
-            "CREATE RULE _hail_hydra_insert AS ON INSERT TO %(table)s DO INSTEAD "
+            "CREATE OR REPLACE RULE _hail_hydra_insert AS ON INSERT TO %(table)s DO INSTEAD "
             "INSERT INTO _raw_%(table)s "
             "(_id, _branch_name, %(fields)s) "
             "(SELECT nextval('_raw_%(table)s__id_seq') _id, hydra_branch() _branch_name, %(vals)s) "
@@ -302,16 +493,15 @@ def initialize_model_for_hydra(ModelCls):
         )
 
         db_cur.execute(
-            "CREATE RULE _hail_hydra_update AS ON UPDATE TO %(table)s "
+            "CREATE OR REPLACE RULE _hail_hydra_update AS ON UPDATE TO %(table)s "
             "DO INSTEAD ("
             "INSERT INTO _raw_%(table)s "
             "(_id, _branch_name, %(fields)s) "
             "SELECT _id, hydra_branch(), %(fields)s "
             "FROM _raw_%(table)s "
             "WHERE hydra_branch() IS NOT NULL AND _id = OLD.id "
-            "      AND _branch_name IS NULL AND NOT EXISTS ("
-            "          SELECT 1 FROM _raw_%(table)s WHERE "
-            "          _id = OLD.id AND _branch_name = hydra_branch()); "
+            "      AND _branch_name IS NULL "
+            "ON CONFLICT (_id, _branch_name) DO NOTHING; "
             "UPDATE _raw_%(table)s "
             "SET %(value_map)s, _updated = statement_timestamp() "
             "WHERE _id = OLD.id AND "
@@ -324,15 +514,93 @@ def initialize_model_for_hydra(ModelCls):
         )
 
         # DELETE rule
-        # A delete sets the deleted flag
+        # A delete sets the deleted flag - in a branch, on the branch's copy
+        # of the row, made if the branch hasn't touched the row yet
         db_cur.execute(
-            "CREATE RULE _hail_hydra_delete AS ON DELETE TO %(table)s DO INSTEAD "
+            "CREATE OR REPLACE RULE _hail_hydra_delete AS ON DELETE TO %(table)s DO INSTEAD ("
+            "INSERT INTO _raw_%(table)s "
+            "(_id, _branch_name, _deleted, %(fields)s) "
+            "SELECT OLD.id, hydra_branch(), 't', %(old_vals)s "
+            "WHERE hydra_branch() IS NOT NULL "
+            "ON CONFLICT (_id, _branch_name) DO UPDATE "
+            "SET _deleted = 't', _updated = statement_timestamp(); "
             "UPDATE _raw_%(table)s "
             "SET _deleted = 't', _updated = statement_timestamp() "
-            "WHERE _id = OLD.id AND "
-            "_branch_name IS NOT DISTINCT FROM hydra_branch() "
-            "RETURNING id, %(fields)s"
+            "WHERE _id = OLD.id AND _branch_name IS NULL AND hydra_branch() IS NULL)"
             "" % {'table': ModelCls._meta.db_table,
-                  'fields': ', '.join(fields_except_pk)}
+                  'fields': ', '.join(fields_except_pk),
+                  'old_vals': ', '.join(['OLD.%s' % col for col in fields_except_pk])}
         )
 
+
+def lock_branch(db_cur, branch_name):
+    """Takes a transaction-scoped advisory lock on branch_name, serializing
+    merges of that branch without blocking writers in any other. Writers in
+    the branch itself hold the lock shared, so taking it waits them out."""
+    db_cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+                   (HYDRA_LOCK_NAMESPACE, branch_name))
+
+def merge_branch(branch_obj, chunk_size=1000):
+    """Folds every row changed in branch_obj into the default branch and marks
+    the branch merged. Rows are moved in chunks of chunk_size, each committed
+    on its own (unless called inside a transaction), so that neither readers nor
+    writers elsewhere wait on the merge as a whole."""
+    if branch_obj.state == u'merged':
+        raise ValueError('Branch %s is already merged.' % branch_obj.branch_name)
+    # Closing the branch first keeps rows deleted in default by the merge from
+    # being copied back into it, keeps it from being activated again, and
+    # turns away writers still working in it.
+    set_branch_state(branch_obj, u'closed')
+    for model_cls in hydrized_models():
+        for alias in connections:
+            if router.allow_migrate(alias, model_cls):
+                merge_model_branch(model_cls, branch_obj.branch_name,
+                                   using=alias, chunk_size=chunk_size)
+    set_branch_state(branch_obj, u'merged')
+
+def set_branch_state(branch_obj, state):
+    """Sets the state of branch_obj on its own database and every database
+    mirroring it, once writes in flight in the branch there have committed."""
+    aliases = hydra_table_databases() | set([router.db_for_write(Branch)])
+    for alias in sorted(aliases):
+        with transaction.atomic(using=alias):
+            lock_branch(connections[alias].cursor(), branch_obj.branch_name)
+            Branch.objects.using(alias).filter(branch_name=branch_obj.branch_name) \
+                                       .update(state=state, last_modified=timezone.now())
+    branch_obj.state = state
+
+def merge_model_branch(ModelCls, branch_name, using=None, chunk_size=1000):
+    using = using or router.db_for_write(ModelCls)
+    fields_except_pk = [field.column for field in ModelCls._meta.fields if not field.primary_key]
+    # Through rows land on the default row joining the same pair
+    conflict_key = m2m_key(ModelCls) or ['_id']
+    # Moving rows with DELETE ... RETURNING means a concurrent write in the
+    # branch either lands before its row is moved, or finds it gone and
+    # copies the freshly merged default row instead.
+    merge_sql = (
+        "WITH moved AS ("
+        "DELETE FROM _raw_%(table)s WHERE id IN ("
+        "SELECT id FROM _raw_%(table)s WHERE _branch_name = %%s "
+        "ORDER BY _id LIMIT %%s FOR UPDATE) "
+        "RETURNING _id, _deleted, %(fields)s) "
+        "INSERT INTO _raw_%(table)s "
+        "(_id, _branch_name, _deleted, %(fields)s) "
+        "SELECT _id, NULL, _deleted, %(fields)s FROM moved "
+        "ON CONFLICT (%(key)s) WHERE _branch_name IS NULL DO UPDATE "
+        "SET _deleted = EXCLUDED._deleted, _updated = statement_timestamp(), "
+        "%(value_map)s"
+        "" % {'table': ModelCls._meta.db_table,
+              'fields': ', '.join(fields_except_pk),
+              'key': ', '.join(conflict_key),
+              'value_map': ', '.join(['%(col)s = EXCLUDED.%(col)s' % {'col': col}
+                                      for col in fields_except_pk])}
+    )
+    db_cur = connections[using].cursor()
+    moved = chunk_size
+    while moved == chunk_size:
+        with transaction.atomic(using=using):
+            lock_branch(db_cur, branch_name)
+            db_cur.execute(merge_sql, (branch_name, chunk_size))
+            moved = db_cur.rowcount
+        logger.debug('Merged %d rows of %s from branch %s',
+                     moved, ModelCls._meta.db_table, branch_name)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from django.core.management.color import no_style
+from django.core.management.commands.flush import Command as FlushCommand
+from django.db import connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.runner import DiscoverRunner
+
+from . import branch, deactivate_branch
+from .models import Branch, initialize_hydra
+from .utils import hydra_table_databases, hydrized_tables
+
+_hydrized = False
+def hydrize_test_databases():
+    """Initializes every hydrized model on the test databases. The DDL is
+    committed, so it only needs to happen once per test run - each test case
+    then works inside a transaction (or flushes the raw tables) on top of it."""
+    global _hydrized
+    if _hydrized:
+        return
+    for alias in hydra_table_databases():
+        if connections[alias].settings_dict['TEST'].get('MIRROR'):
+            continue
+        initialize_hydra(using=alias)
+    _hydrized = True
+
+
+class HydraTestRunner(DiscoverRunner):
+    """Test runner that hydrizes the test databases right after creating them."""
+    def setup_databases(self, **kwargs):
+        old_config = super(HydraTestRunner, self).setup_databases(**kwargs)
+        hydrize_test_databases()
+        return old_config
+
+
+class HydraTestMixin(object):
+    # Branches are mirrored to every database holding raw tables
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        super(HydraTestMixin, cls).setUpClass()
+        hydrize_test_databases()
+
+    def _post_teardown(self):
+        super(HydraTestMixin, self)._post_teardown()
+        # Every test starts out in the default branch
+        deactivate_branch()
+
+    def create_branches(self, count, created_by, prefix='branch'):
+        """Creates `count` open branches named <prefix>_0 and up."""
+        # Saved one by one, as bulk_create skips the signal mirroring them
+        return [Branch.objects.create(branch_name='%s_%d' % (prefix, i),
+                                      created_by=created_by)
+                for i in range(count)]
+
+    def seed(self, model_cls, rows, make_fields, branches=(None,)):
+        """Inserts `rows` instances of model_cls into each of `branches` (None
+        being the default branch). make_fields(branch_obj, i) returns the
+        field values of the i-th row."""
+        for branch_obj in branches:
+            with branch(branch_obj):
+                model_cls.objects.bulk_create([model_cls(**make_fields(branch_obj, i))
+                                               for i in range(rows)])
+
+
+class HydraTestCase(HydraTestMixin, TestCase):
+    """TestCase against hydrized models. The schema is hydrized once per run
+    and each test's data is rolled back like any other TestCase."""
+
+
+class HydraTransactionTestCase(HydraTestMixin, TransactionTestCase):
+    """TransactionTestCase against hydrized models, for tests that need
+    committed data visible to other connections."""
+    def _fixture_teardown(self):
+        # The stock flush would TRUNCATE the views that stand in for hydrized
+        # tables, so truncate their raw tables instead - then let apps put
+        # back content types, permissions and the like, as flush does.
+        hydrized = hydrized_tables()
+        for alias in self._databases_names(include_mirrors=False):
+            connection = connections[alias]
+            tables = connection.introspection.django_table_names(only_existing=True)
+            if alias in hydra_table_databases():
+                tables = [table for table in tables if table not in hydrized]
+                tables.extend('_raw_%s' % table for table in hydrized)
+            with transaction.atomic(using=alias):
+                cursor = connection.cursor()
+                for sql in connection.ops.sql_flush(no_style(), tables, [],
+                                                    allow_cascade=True):
+                    cursor.execute(sql)
+            if self.available_apps is None:
+                FlushCommand.emit_post_migrate(0, False, alias)
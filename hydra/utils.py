@@ -6,13 +6,88 @@ import logging
 logger = logging.getLogger(__name__)
 
 import collections
+from functools import wraps
 
+from django.apps import apps
 from django.conf import settings
-from django.db import models
+from django.db import models, router, connections
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8
+    from django.test.signals import setting_changed
+
+_cache = {}
+
+def _cached(func):
+    """Caches what func returns once the app registry is ready - before then,
+    models are still being hydrized. Compilers consult these results for
+    every query."""
+    @wraps(func)
+    def inner():
+        if func.__name__ in _cache:
+            return _cache[func.__name__]
+        result = func()
+        if apps.ready:
+            _cache[func.__name__] = result
+        return result
+    return inner
+
+def clear_caches(setting=None, **kwargs):
+    """Forgets cached models, tables and databases. Called when settings they
+    derive from change, and wherever routers are swapped out directly."""
+    if setting in (None, 'HYDRA_MODELS', 'DATABASES', 'DATABASE_ROUTERS'):
+        _cache.clear()
+setting_changed.connect(clear_caches)
 
 def is_hydrized(model):
-    model = model_ref(model) if issubclass(model, Model) else model
-    return model in settings.HYDRA_MODELS
+    if isinstance(model, type) and issubclass(model, models.Model):
+        if model._meta.auto_created:
+            # M2M through models follow the model declaring the field
+            return is_hydrized(model._meta.auto_created)
+        model = model_ref(model)
+    return model.lower() in [s.lower() for s in settings.HYDRA_MODELS]
+
+@_cached
+def hydrized_models():
+    """Returns the model classes named in settings.HYDRA_MODELS along with their
+    auto-created M2M through models, ordered so that models come after those
+    they have foreign keys to."""
+    pending = set(flatten(with_m2ms(models.get_model(*ref.split('.', 1)))
+                          for ref in settings.HYDRA_MODELS))
+    pending -= forbidden_models(as_cls=True)
+    ordered = []
+    while pending:
+        ready = [m for m in pending
+                 if not any(f.rel.to in pending and f.rel.to is not m
+                            for f in m._meta.fields
+                            if isinstance(f, models.ForeignKey))] or list(pending)
+        ordered.extend(sorted(ready, key=model_ref))
+        pending -= set(ready)
+    return tuple(ordered)
+
+def m2m_key(model_cls):
+    """For the auto-created through model of a ManyToManyField, returns the
+    columns of its two foreign keys, which identify a row across branches.
+    Returns None for any other model."""
+    if not model_cls._meta.auto_created:
+        return None
+    return [f.column for f in model_cls._meta.fields
+            if isinstance(f, models.ForeignKey)]
+
+@_cached
+def hydrized_tables():
+    """Returns the database tables backing hydrized models"""
+    return frozenset(model_cls._meta.db_table for model_cls in hydrized_models())
+
+@_cached
+def hydra_table_databases():
+    """Returns the aliases of the databases holding raw tables - those the
+    router allows hydrized models to be migrated to. Replicas are read from
+    but never written to directly."""
+    return frozenset(alias for alias in connections
+                     for model_cls in hydrized_models()
+                     if router.allow_migrate(alias, model_cls))
 
 def forbidden_models(as_cls=False):
     to_return = [
@@ -23,8 +98,16 @@ def forbidden_models(as_cls=False):
         'sites.Site'
     ]
     if as_cls:
-        to_return = map(lambda model_ref: models.get_model(*model_ref.split('.', 1)),
-                        to_return)
+        # Hydra models are generated while the app registry is still being
+        # populated, and not every forbidden model's app need be installed.
+        from django.apps import apps
+        classes = []
+        for model_ref in to_return:
+            try:
+                classes.append(apps.get_registered_model(*model_ref.split('.', 1)))
+            except LookupError:
+                pass
+        to_return = classes
     return set(to_return)
 
 
@@ -42,16 +125,11 @@ def flatten(iter):
             yield item
 
 def with_m2ms(model_cls):
-    """Returns a set of models with their m2m "through" tables"""
-    s = set([model_cls])
-    try:
-        return s | {
-            o for o in flatten(
-                [
-                    [f.rel.through for f in m._meta.many_to_many]
-                    for m in s
-                ]
-            )
-        }
-    except Exception, e:
-        import pdb; pdb.set_trace()
+    """Returns a set of models with their auto-created m2m "through" tables.
+
+    Explicit ``through`` models are ordinary models and are only hydrized when
+    listed in settings.HYDRA_MODELS themselves."""
+    return set([model_cls]) | {
+        f.rel.through for f in model_cls._meta.many_to_many
+        if isinstance(f.rel.through, type) and f.rel.through._meta.auto_created
+    }
@@ -20,7 +20,19 @@ class Book(models.Model):
     title = models.CharField(max_length=120)
     author = models.ForeignKey(Author)
     isbn = models.CharField(max_length=120)
-    # read_by = models.ManyToManyField(Reader)
+    read_by = models.ManyToManyField(Reader)
 
     def __unicode__(self):
         return self.title
+
+class Shelf(models.Model):
+    name = models.CharField(max_length=120)
+    books = models.ManyToManyField(Book, through='Shelving')
+
+    def __unicode__(self):
+        return self.name
+
+class Shelving(models.Model):
+    shelf = models.ForeignKey(Shelf)
+    book = models.ForeignKey(Book)
+    position = models.IntegerField(default=0)
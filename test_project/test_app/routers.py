@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+
+class ReplicaRouter(object):
+    """Nothing is migrated to the replica, which mirrors default. Reads are
+    only sent there when read_from_replica is set."""
+    def __init__(self, read_from_replica=False):
+        self.read_from_replica = read_from_replica
+
+    def db_for_read(self, model, **hints):
+        if self.read_from_replica:
+            return 'replica'
+
+    def allow_migrate(self, db, model):
+        if db == 'replica':
+            return False
@@ -1,33 +1,305 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import json
 import logging
+import threading
+from StringIO import StringIO
 
 logger = logging.getLogger(__name__)
 
-from django.conf import settings
-from django.contrib.auth.models import User
-from django.db import models, connections
-from django.test import TestCase
+from django.contrib.auth.models import User, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connections, router, transaction
+from django.http import Http404
+from django.test import RequestFactory
+from django.test.utils import override_settings
 
-from hydra import activate_branch, deactivate_branch
+from hydra import activate_branch, deactivate_branch, branch
 from hydra import models as hydra
+from hydra.explain import analyze_plan, explain_queryset
+from hydra.middleware import BranchMiddleware
+from hydra.utils import hydrized_models, hydrized_tables, is_hydrized, with_m2ms
+from hydra.testing import HydraTestCase, HydraTransactionTestCase
 
-from .models import Reader  #, Author, Book
+from .models import Reader, Author, Book, Shelf, Shelving
+from .routers import ReplicaRouter
 
 
-class HydraInitializedTestCase(TestCase):
+class HydraInitializedTestCase(HydraTestCase):
     def setUp(self):
-        hydra.get_session_identifier_from_sequence(connection=connections['default'])
-        for model in settings.HYDRA_MODELS:
-            model_cls = models.get_model(*model.split('.', 1))
-            hydra.initialize_model_for_hydra(model_cls)
         self.user = User.objects.create_user('jpschmoe',
                                              'joeschmoe@example.com',
                                              '12345')
         self.branch = hydra.Branch.objects.create(branch_name='test',
                                                   created_by=self.user)
 
+    def test_hydrized_tables_are_cached(self):
+        self.assertIs(hydrized_tables(), hydrized_tables())
+        self.assertIn('test_app_book_read_by', hydrized_tables())
+        with override_settings(HYDRA_MODELS={'test_app.Reader'}):
+            self.assertEqual(hydrized_tables(), {'test_app_reader'})
+        self.assertIn('test_app_book', hydrized_tables())
+
+    def test_sync_is_kept_for_the_transaction(self):
+        activate_branch(self.branch)
+        with transaction.atomic():
+            # One sync, then the three counts
+            with self.assertNumQueries(4):
+                for i in range(3):
+                    Reader.objects.count()
+        # Rolling back a savepoint the sync happened under undoes it...
+        try:
+            with transaction.atomic():
+                deactivate_branch()
+                Reader.objects.count()
+                raise ValueError
+        except ValueError:
+            pass
+        with self.assertNumQueries(2):
+            Reader.objects.count()
+        cursor = connections['default'].cursor()
+        cursor.execute('SELECT hydra_branch()')
+        self.assertIsNone(cursor.fetchone()[0])
+        # ...while rolling back one opened after it does not
+        try:
+            with transaction.atomic():
+                raise ValueError
+        except ValueError:
+            pass
+        with self.assertNumQueries(1):
+            Reader.objects.count()
+
+    def test_branch_mirror_follows_transaction(self):
+        # A branch whose create was rolled back can be created again, even
+        # though its mirror was written outside of that transaction
+        try:
+            with transaction.atomic():
+                hydra.Branch.objects.create(branch_name='b2', created_by=self.user)
+                raise ValueError
+        except ValueError:
+            pass
+        branch_obj = hydra.Branch.objects.create(branch_name='b2',
+                                                 created_by=self.user)
+        self.assertEqual(branch_obj._state.db, 'default')
+        self.assertEqual(hydra.Branch.objects.using('other')
+                                              .filter(branch_name='b2').count(), 1)
+
+    def test_subquery_syncs_branch(self):
+        # A query on a model Hydra doesn't manage still syncs the branch when
+        # it filters on a hydrized table
+        with branch(self.branch):
+            Reader.objects.create(name=self.user.username,
+                                  email='bookworm@example.com')
+        Reader.objects.count()
+        activate_branch(self.branch)
+        self.assertTrue(User.objects.filter(
+            username__in=Reader.objects.values('name')).exists())
+        self.assertFalse(User.objects.exclude(
+            username__in=Reader.objects.values('name')).exists())
+
+    def test_branch_context_restores_previous_branch(self):
+        cursor = connections['default'].cursor()
+        with branch(self.branch):
+            Reader.objects.create(name='Book Worm',
+                                  email='bookworm@example.com')
+            cursor.execute('SELECT hydra_branch()')
+            self.assertEqual(cursor.fetchone()[0], self.branch.branch_name)
+            with branch(None):
+                self.assertFalse(Reader.objects.exists())
+            self.assertTrue(Reader.objects.exists())
+        self.assertFalse(Reader.objects.exists())
+
+    def test_branch_decorator_is_thread_safe(self):
+        # Leaving a decorated function restores this thread's connection,
+        # even while another thread is still inside it
+        @branch(self.branch)
+        def work(callback):
+            callback()
+
+        thread_entered, main_left = threading.Event(), threading.Event()
+        def in_thread():
+            work(lambda: (thread_entered.set(), main_left.wait()))
+        thread = threading.Thread(target=in_thread)
+
+        def start_thread():
+            thread.start()
+            thread_entered.wait()
+        work(start_thread)
+        try:
+            self.assertIsNone(connections['default'].hydra_branch)
+        finally:
+            main_left.set()
+            thread.join()
+
+    def test_closed_branch_rejects_writes(self):
+        reader_obj = Reader.objects.create(name='Book Worm',
+                                           email='bookworm@example.com')
+        activate_branch(self.branch)
+        hydra.set_branch_state(self.branch, u'closed')
+        reader_obj.name = 'Big Worm'
+        with transaction.atomic():
+            self.assertRaisesMessage(DatabaseError, 'Branch test is not open',
+                                     reader_obj.save)
+        # Deletes in default skip closed branches rather than fail
+        deactivate_branch()
+        reader_obj.delete()
+        self.assertFalse(hydra.HydraReader.objects.filter(
+            _branch_name=self.branch.branch_name).exists())
+
+    def test_merge_branch_delete_of_default_row(self):
+        reader_obj = Reader.objects.create(name='Book Worm',
+                                           email='bookworm@example.com')
+        with branch(self.branch):
+            Reader.objects.get(pk=reader_obj.pk).delete()
+            self.assertFalse(Reader.objects.filter(pk=reader_obj.pk).exists())
+        self.assertTrue(Reader.objects.filter(pk=reader_obj.pk).exists())
+        hydra.merge_branch(self.branch)
+        self.assertFalse(Reader.objects.filter(pk=reader_obj.pk).exists())
+
+    def test_upgrade_initialized_model(self):
+        # A database hydrized before the default-row index and the open
+        # branch trigger existed
+        cursor = connections['default'].cursor()
+        cursor.execute('DROP INDEX test_app_reader_default_eff_id_uniq')
+        cursor.execute('DROP TRIGGER _hail_hydra_open_test_app_reader '
+                       'ON _raw_test_app_reader')
+        cursor.execute("CREATE VIEW _active_branch (branch_name) AS "
+                       "SELECT NULL::VARCHAR(50)")
+        hydra.after_hydra_migrate(sender=hydra, db='default')
+        hydra.initialize_model_for_hydra(Reader)
+        cursor.execute("SELECT count(*) FROM pg_indexes WHERE "
+                       "indexname = 'test_app_reader_default_eff_id_uniq'")
+        self.assertEqual(cursor.fetchone()[0], 1)
+        cursor.execute("SELECT count(*) FROM pg_trigger WHERE "
+                       "tgname = '_hail_hydra_open_test_app_reader'")
+        self.assertEqual(cursor.fetchone()[0], 1)
+        # The view and rules still work once replaced
+        with branch(self.branch):
+            Reader.objects.create(name='Book Worm', email='bookworm@example.com')
+            self.assertEqual(Reader.objects.count(), 1)
+        self.assertEqual(Reader.objects.count(), 0)
+
+    def test_branch_with_closed_branch(self):
+        # A failed activation leaves nothing behind for a reused decorator
+        hydra.set_branch_state(self.branch, u'closed')
+        context = branch(self.branch)
+        self.assertRaises(ValueError, context.__enter__)
+        self.assertEqual(context._previous, [])
+
+    def test_seed_branches(self):
+        branches = self.create_branches(3, self.user)
+        self.seed(Reader, 10,
+                  lambda branch_obj, i: {'name': 'Reader %d' % i,
+                                         'email': 'reader%d@example.com' % i},
+                  branches=[None] + branches)
+        self.assertEqual(hydra.HydraReader.objects.count(), 40)
+        self.assertEqual(Reader.objects.count(), 10)
+        with branch(branches[0]):
+            self.assertEqual(Reader.objects.count(), 20)
+
+    def test_explain_queryset(self):
+        default_report, branch_report = explain_queryset(
+            Reader.objects.filter(name='Book Worm'), self.branch)
+        self.assertIsNone(default_report['branch'])
+        self.assertEqual(branch_report['branch'], self.branch.branch_name)
+        for report in (default_report, branch_report):
+            self.assertGreaterEqual(report['total_time'],
+                                    report['raw_scan_time'] + report['window_time'])
+            # name isn't indexed
+            self.assertIn('_raw_test_app_reader', report['seq_scans'])
+            self.assertEqual(report['branch_filters'], ['_raw_test_app_reader'])
+        # The branch requested around the EXPLAIN is not left active
+        self.assertIsNone(getattr(connections['default'], 'hydra_branch', None))
+
+    def test_analyze_plan_by_relation(self):
+        # A raw table scanned in a SubPlan is raw scan time, and other
+        # functions aren't taken for hydra_branch()
+        report = analyze_plan({'Execution Time': 10, 'Plan': {
+            'Node Type': 'Seq Scan', 'Relation Name': '_raw_test_app_book',
+            'Actual Total Time': 10, 'Actual Loops': 1, 'Plans': [
+                {'Node Type': 'Function Scan', 'Parent Relationship': 'InitPlan',
+                 'Actual Total Time': 1, 'Actual Loops': 1},
+                {'Node Type': 'Index Scan', 'Parent Relationship': 'SubPlan',
+                 'Relation Name': '_raw_test_app_reader',
+                 'Index Cond': "(_branch_name = (NULLIF(current_setting("
+                               "'hydra.branch'::text, true), ''::text)))",
+                 'Actual Total Time': 0.5, 'Actual Loops': 8}]}})
+        self.assertEqual(report['raw_scan_time'], 9)
+        self.assertEqual(report['seq_scans'], ['_raw_test_app_book'])
+        self.assertEqual(report['branch_filters'], ['_raw_test_app_reader'])
+
+    def test_hydra_explain_command(self):
+        out = StringIO()
+        call_command('hydra_explain', 'test_app.Reader', branch='test',
+                     filters=['name=Book Worm'], stdout=out)
+        self.assertIn('Branch: test', out.getvalue())
+        self.assertIn('sequential scan on _raw_test_app_reader', out.getvalue())
+        self.assertIn('Branch filtered in the scans of _raw_test_app_reader',
+                      out.getvalue())
+        hydra.set_branch_state(self.branch, u'closed')
+        self.assertRaises(CommandError, call_command, 'hydra_explain',
+                          'test_app.Reader', branch='test', stdout=out)
+
+    def test_m2m_in_branch(self):
+        author = Author.objects.create(name='Ann Author', email='ann@example.com')
+        book = Book.objects.create(title='Hydra', author=author, isbn='123')
+        worm = Reader.objects.create(name='Book Worm', email='bookworm@example.com')
+        tugger = Reader.objects.create(name='Little Tugger', email='tugger@example.com')
+        book.read_by.add(worm)
+
+        with branch(self.branch):
+            book.read_by.add(tugger)
+            book.read_by.remove(worm)
+            books = list(Book.objects.prefetch_related('read_by'))
+            self.assertEqual([r.pk for r in books[0].read_by.all()], [tugger.pk])
+            # Removing and adding a pair again in the branch revives its row
+            book.read_by.remove(tugger)
+            book.read_by.add(tugger)
+            self.assertEqual([r.pk for r in book.read_by.all()], [tugger.pk])
+        books = list(Book.objects.prefetch_related('read_by'))
+        self.assertEqual([r.pk for r in books[0].read_by.all()], [worm.pk])
+
+        # Overlay rows are found by key rather than by windowing the raw table
+        for report in explain_queryset(
+                Book.read_by.through.objects.filter(book=book), self.branch):
+            self.assertNotIn('WindowAgg', json.dumps(report['plan']))
+
+        hydra.merge_branch(self.branch)
+        self.assertEqual([r.pk for r in book.read_by.all()], [tugger.pk])
+
+    def test_explicit_through_model(self):
+        # Explicit through models are hydrized only when listed themselves
+        self.assertEqual(with_m2ms(Shelf), {Shelf})
+        self.assertTrue(is_hydrized(Shelving))
+        self.assertIn(Shelving, hydrized_models())
+        with override_settings(HYDRA_MODELS={'test_app.Book', 'test_app.Shelf'}):
+            self.assertFalse(is_hydrized(Shelving))
+            self.assertNotIn(Shelving, hydrized_models())
+
+        author = Author.objects.create(name='Ann Author', email='ann@example.com')
+        book = Book.objects.create(title='Hydra', author=author, isbn='123')
+        sequel = Book.objects.create(title='Hydra II', author=author, isbn='456')
+        shelf = Shelf.objects.create(name='Mythology')
+        Shelving.objects.create(shelf=shelf, book=book, position=1)
+
+        with branch(self.branch):
+            Shelving.objects.filter(book=book).update(position=2)
+            Shelving.objects.create(shelf=shelf, book=sequel, position=1)
+            self.assertEqual(
+                list(shelf.books.order_by('shelving__position').values_list('pk', flat=True)),
+                [sequel.pk, book.pk])
+        self.assertEqual(list(shelf.books.values_list('pk', flat=True)), [book.pk])
+        self.assertEqual(Shelving.objects.get().position, 1)
+
+        hydra.merge_branch(self.branch)
+        self.assertEqual(
+            list(shelf.books.order_by('shelving__position').values_list('pk', flat=True)),
+            [sequel.pk, book.pk])
+
     def test_simple_model_default_branch(self):
         # A simple insert/update/delete confirming that everything works as
         # normal.
@@ -134,13 +406,212 @@ class HydraInitializedTestCase(TestCase):
         self.assert_(branch_raw_reader_obj._deleted)
 
 
+class BranchMiddlewareTestCase(HydraTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('jpschmoe',
+                                             'joeschmoe@example.com',
+                                             '12345')
+        self.branch = hydra.Branch.objects.create(branch_name='test',
+                                                  created_by=self.user)
+        self.middleware = BranchMiddleware()
+        self.factory = RequestFactory()
+
+    def request(self, session_branch=None, **headers):
+        request = self.factory.get('/', **headers)
+        request.session = {}
+        if session_branch:
+            request.session['hydra_branch'] = session_branch
+        return request
+
+    def test_session_branch(self):
+        request = self.request('test')
+        self.middleware.process_request(request)
+        self.assertEqual(connections['default'].hydra_branch, 'test')
+        self.middleware.process_response(request, None)
+        self.assertIsNone(connections['default'].hydra_branch)
+
+    def test_header_is_opt_in(self):
+        request = self.request(HTTP_X_HYDRA_BRANCH='test')
+        self.middleware.process_request(request)
+        self.assertIsNone(getattr(connections['default'], 'hydra_branch', None))
+        with override_settings(HYDRA_BRANCH_HEADER='HTTP_X_HYDRA_BRANCH'):
+            self.middleware.process_request(request)
+            self.assertEqual(connections['default'].hydra_branch, 'test')
+            self.middleware.process_response(request, None)
+
+    def test_session_branch_no_longer_open(self):
+        # Users who picked a branch since merged carry on in default
+        hydra.set_branch_state(self.branch, u'merged')
+        request = self.request('test')
+        self.assertIsNone(self.middleware.process_request(request))
+        self.assertNotIn('hydra_branch', request.session)
+        self.assertIsNone(getattr(connections['default'], 'hydra_branch', None))
+
+    @override_settings(HYDRA_BRANCH_HEADER='HTTP_X_HYDRA_BRANCH')
+    def test_unknown_or_closed_header_branch(self):
+        self.assertRaises(Http404, self.middleware.process_request,
+                          self.request(HTTP_X_HYDRA_BRANCH='nonexistent'))
+        self.branch.state = u'closed'
+        self.branch.save()
+        self.assertRaises(Http404, self.middleware.process_request,
+                          self.request(HTTP_X_HYDRA_BRANCH='test'))
 
+    def test_branch_permission(self):
+        class DenyingMiddleware(BranchMiddleware):
+            def has_branch_permission(self, request, branch_obj):
+                return False
+        self.assertRaises(PermissionDenied, DenyingMiddleware().process_request,
+                          self.request('test'))
+        self.assertIsNone(getattr(connections['default'], 'hydra_branch', None))
+
+    def test_exception_restores_branch(self):
+        other, = self.create_branches(1, self.user, prefix='other')
+        activate_branch(other)
+        request = self.request('test')
+        self.middleware.process_request(request)
+        self.assertEqual(connections['default'].hydra_branch, 'test')
+        self.middleware.process_exception(request, ValueError())
+        self.assertEqual(connections['default'].hydra_branch, other.branch_name)
+
+
+class BranchSessionTestCase(HydraTransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('jpschmoe',
+                                             'joeschmoe@example.com',
+                                             '12345')
+        self.branch = hydra.Branch.objects.create(branch_name='test',
+                                                  created_by=self.user)
+
+    def test_activation_is_lazy(self):
+        # Activating a branch costs nothing until a hydrized table is queried,
+        # and only the first such query syncs the session.
+        with self.assertNumQueries(0):
+            activate_branch(self.branch)
+        Reader.objects.count()
+        with self.assertNumQueries(1):
+            Reader.objects.count()
+        cursor = connections['default'].cursor()
+        cursor.execute('SELECT hydra_branch()')
+        self.assertEqual(cursor.fetchone()[0], self.branch.branch_name)
+        deactivate_branch()
+        Reader.objects.count()
+        cursor.execute('SELECT hydra_branch()')
+        self.assertIsNone(cursor.fetchone()[0])
+
+    def test_rollback_undoes_sync(self):
+        activate_branch(self.branch)
+        try:
+            with transaction.atomic():
+                Reader.objects.count()
+                raise ValueError
+        except ValueError:
+            pass
+        # The branch synced inside the rolled back transaction is synced again
+        Reader.objects.create(name='Book Worm', email='bookworm@example.com')
+        deactivate_branch()
+        self.assertFalse(Reader.objects.exists())
 
+    def test_replica_and_second_database(self):
+        # The branch is mirrored to the other database, where raw tables
+        # reference it
+        self.assertEqual(hydra.Branch.objects.using('other')
+                                              .get(branch_name='test').state,
+                         u'open')
+        old_routers = router.routers
+        router.routers = [ReplicaRouter(read_from_replica=True)]
+        try:
+            activate_branch(self.branch)
+            Reader.objects.create(name='Book Worm', email='bookworm@example.com')
+            Reader.objects.using('other').create(name='Little Tugger',
+                                                 email='tugger@example.com')
+            # Read through the read-only replica session
+            self.assertEqual(list(Reader.objects.values_list('name', flat=True)),
+                             ['Book Worm'])
+            self.assertEqual(Reader.objects.using('other').count(), 1)
+            deactivate_branch()
+            self.assertFalse(Reader.objects.exists())
+            self.assertFalse(Reader.objects.using('other').exists())
+        finally:
+            router.routers = old_routers
 
+        hydra.merge_branch(self.branch)
+        self.assertEqual(hydra.Branch.objects.using('other')
+                                              .get(branch_name='test').state,
+                         u'merged')
+        self.assertEqual(Reader.objects.using('other').count(), 1)
 
 
+class FlushTestCase(HydraTransactionTestCase):
+    def test_flush_keeps_content_types(self):
+        Reader.objects.create(name='Book Worm', email='bookworm@example.com')
+        self._fixture_teardown()
+        self.assertFalse(hydra.HydraReader.objects.exists())
+        reader_type = ContentType.objects.get(app_label='test_app', model='reader')
+        self.assertTrue(Permission.objects.filter(content_type=reader_type).exists())
 
 
+class ConcurrentMergeTestCase(HydraTransactionTestCase):
+    def test_merge_with_parallel_writers(self):
+        user = User.objects.create_user('jpschmoe',
+                                        'joeschmoe@example.com',
+                                        '12345')
+        merging, = self.create_branches(1, user, prefix='merging')
+        others = self.create_branches(3, user, prefix='other')
+        make_fields = lambda branch_obj, i: {'name': 'Reader %d' % i,
+                                             'email': 'reader%d@example.com' % i}
+        self.seed(Reader, 200, make_fields)
+        reader_ids = list(Reader.objects.values_list('pk', flat=True))
+        with branch(merging):
+            Reader.objects.update(name='Merged')
 
+        errors = []
+        rejected = []
+        merged = threading.Event()
+        def write(branch_obj, name):
+            try:
+                with branch(branch_obj):
+                    while True:
+                        # Writers in the merging branch keep at it until a
+                        # pass started after the merge had finished
+                        finished = branch_obj is not merging or merged.is_set()
+                        for pk in reader_ids:
+                            Reader.objects.filter(pk=pk).update(name=name)
+                        if finished:
+                            break
+            except DatabaseError as e:
+                # Writers in the merging branch are turned away once it closes
+                if branch_obj is merging and 'is not open' in str(e):
+                    rejected.append(e)
+                else:
+                    errors.append(e)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections['default'].close()
 
+        # Two writers per branch race each other's copy-on-write as well
+        writers = [threading.Thread(target=write,
+                                    args=(branch_obj, branch_obj.branch_name))
+                   for branch_obj in others * 2]
+        writers.extend(threading.Thread(target=write, args=(merging, 'Merged'))
+                       for i in range(2))
+        for writer in writers:
+            writer.start()
+        try:
+            hydra.merge_branch(merging, chunk_size=25)
+        finally:
+            merged.set()
+        for writer in writers:
+            writer.join()
 
+        self.assertEqual(errors, [])
+        self.assertEqual(len(rejected), 2)
+        self.assertEqual(hydra.Branch.objects.get(pk=merging.pk).state, u'merged')
+        self.assertEqual(set(Reader.objects.values_list('name', flat=True)),
+                         {'Merged'})
+        self.assertFalse(hydra.HydraReader.objects.filter(
+            _branch_name=merging.branch_name).exists())
+        for branch_obj in others:
+            with branch(branch_obj):
+                self.assertEqual(set(Reader.objects.values_list('name', flat=True)),
+                                 {branch_obj.branch_name})
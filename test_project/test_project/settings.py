@@ -60,8 +60,16 @@ WSGI_APPLICATION = 'test_project.wsgi.application'
 # https://docs.djangoproject.com/en/1.7/ref/settings/#databases
 import dj_database_url
 DATABASES = {
-    'default': dj_database_url.config(default='postgres://hydra:@localhost:5432/hydra')
+    'default': dj_database_url.config(default='postgres://hydra:@localhost:5432/hydra'),
+    # A second database holding its own copy of the hydrized tables
+    'other': dj_database_url.config(env='OTHER_DATABASE_URL',
+                                    default='postgres://hydra:@localhost:5432/hydra_other'),
 }
+# A read-only session on default, standing in for a hot standby
+DATABASES['replica'] = dict(DATABASES['default'],
+                            OPTIONS={'options': '-c default_transaction_read_only=on'},
+                            TEST={'MIRROR': 'default'})
+DATABASE_ROUTERS = ['test_app.routers.ReplicaRouter']
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
@@ -109,8 +117,12 @@ LOGGING = {
     }
 }
 
+TEST_RUNNER = 'hydra.testing.HydraTestRunner'
+
 HYDRA_MODELS = {
     'test_app.Reader',
     'test_app.Author',
-    'test_app.Book'
+    'test_app.Book',
+    'test_app.Shelf',
+    'test_app.Shelving',
 }